@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 import os
 import re
+import ast
 import uuid
 import time
+import random
 import logging
+import functools
 
 from telegram import (
     Update,
@@ -19,7 +22,6 @@ from telegram.ext import (
     filters,
 )
 from telegram.error import Conflict
-from asteval import Interpreter
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -40,32 +42,135 @@ if not TOKEN:
     logger.error("TELEGRAM_TOKEN is not set in .env")
     exit(1)
 
-aeval = Interpreter()
+MAX_EXPONENT = 10000
+MAX_EXPRESSION_LENGTH = 10000
+
+OPERATOR_TABLE = str.maketrans({"−": "-", "×": "*", "÷": "/"})
+TOKEN_RE = re.compile(r"\d+\.?\d*%|[\d.]+|[+/*()-]")
+RELATIVE_PERCENT_RE = re.compile(r"(?<=[\d.)%])[+-]\d+\.?\d*%")
+INLINE_ALLOWED_CHARS = frozenset("0123456789+-*/(). %")
+NON_OPERAND_TOKENS = frozenset("+-*/(")
+
+# ———————————————
+# Helper: compile arithmetic once, evaluate as bytecode
+# ———————————————
+ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Pow,
+    ast.UAdd, ast.USub,
+)
+
+def safe_pow(base, exp):
+    if exp > MAX_EXPONENT:
+        raise ValueError(f"exponent exceeds {MAX_EXPONENT}")
+    return base ** exp
+
+class ExpressionCompiler(ast.NodeTransformer):
+    def generic_visit(self, node):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError(f"unsupported syntax: {type(node).__name__}")
+        return super().generic_visit(node)
+
+    def visit_Constant(self, node):
+        if type(node.value) not in (int, float):
+            raise ValueError("only numbers are allowed")
+        return node
+
+    def visit_BinOp(self, node):
+        node = self.generic_visit(node)
+        if isinstance(node.op, ast.Pow):
+            return ast.Call(
+                func=ast.Name(id="safe_pow", ctx=ast.Load()),
+                args=[node.left, node.right],
+                keywords=[],
+            )
+        return node
+
+EVAL_GLOBALS = {"__builtins__": {}, "safe_pow": safe_pow}
+
+@functools.lru_cache(maxsize=512)
+def compile_expression(expr: str):
+    tree = ExpressionCompiler().visit(ast.parse(expr, mode="eval"))
+    return compile(ast.fix_missing_locations(tree), "<calc>", "eval")
+
+def evaluate(expr: str):
+    if len(expr) > MAX_EXPRESSION_LENGTH:
+        raise ValueError(f"expression exceeds {MAX_EXPRESSION_LENGTH} chars")
+    return eval(compile_expression(expr), EVAL_GLOBALS)
 
 # ———————————————
-# Helper: convert “10%” → “(prev * 10 / 100)”
+# Helper: convert “100+10%” → “(100 * (100 + 10) / 100)”, “10%” → “(10 / 100)”
 # ———————————————
 def convert_percent(expr: str) -> str:
-    tokens = re.findall(r"\d+\.?\d*%|[\d.]+|[+/*()-]", expr)
-    output, eval_stack = [], []
+    tokens = TOKEN_RE.findall(expr.translate(OPERATOR_TABLE))
+    cleaned = "".join(tokens)
+    if "%" not in cleaned:
+        return cleaned
+    # No binary “+/- N%” → every percent is a plain fraction; rewrite per
+    # token (not on “cleaned”, where adjacent numbers could merge)
+    if not RELATIVE_PERCENT_RE.search(cleaned):
+        return "".join(
+            f"({token[:-1]} / 100)" if token.endswith("%") else token
+            for token in tokens
+        )
+    output, open_parens = [], []
     for token in tokens:
         if token.endswith("%"):
-            num = float(token[:-1])
-            try:
-                prev = aeval("".join(eval_stack))
-                expr_pct = f"({prev} * {num} / 100)"
-                output.append(expr_pct)
-                eval_stack = [expr_pct]
-            except:
-                frac = f"({num} / 100)"
-                output.append(frac)
-                eval_stack = [frac]
+            num = token[:-1]
+            # Base is everything since the innermost open “(” up to a
+            # binary +/-; a unary sign (“2*-10%”) keeps the plain fraction
+            start = open_parens[-1] + 1 if open_parens else 0
+            base = output[start:-1]
+            is_binary = (
+                len(output) >= 2
+                and output[-1] in ("+", "-")
+                and output[-2] not in NON_OPERAND_TOKENS
+            )
+            if base and is_binary:
+                # A ± p% ≡ A * (100 ± p) / 100, rewritten in place so the
+                # base is never copied; a single generated “(…)” group is a
+                # */÷ chain and is extended rather than nested again
+                op = output[-1]
+                if len(base) > 1:
+                    base_expr = f"({''.join(base)})"
+                elif base[0].startswith("("):
+                    base_expr = base[0][1:-1]
+                else:
+                    base_expr = base[0]
+                del output[start:]
+                output.append(f"({base_expr} * (100 {op} {num}) / 100)")
+            else:
+                output.append(f"({num} / 100)")
         else:
+            if token == "(":
+                open_parens.append(len(output))
+            elif token == ")" and open_parens:
+                open_parens.pop()
             output.append(token)
-            if token not in "+-*/()":
-                eval_stack.append(token)
     return "".join(output)
 
+# ———————————————
+# Helper: memoized inline pipeline → (expr, result or None, valid chars)
+# ———————————————
+@functools.lru_cache(maxsize=2048)
+def eval_inline_query(query: str):
+    expr = convert_percent(query)
+    if not expr or not set(expr) <= INLINE_ALLOWED_CHARS:
+        return expr, None, False
+    # Don't let the cache pin oversized expressions; evaluate() rejects them
+    if len(expr) > MAX_EXPRESSION_LENGTH:
+        return f"{expr[:64]}…", None, True
+    try:
+        return expr, str(evaluate(expr)), True
+    except Exception:
+        return expr, None, True
+
+# ———————————————
+# Helper: decorrelated-jitter backoff between retries
+# ———————————————
+def next_delay(prev: float, base: float = 5.0, cap: float = 60.0) -> float:
+    return min(cap, random.uniform(base, prev * 3))
+
 # ———————————————
 # /start handler
 # ———————————————
@@ -87,7 +192,7 @@ async def handle_math_expression(
     expr = convert_percent(text)
     logger.info(f"Evaluating: {expr}")
     try:
-        result = aeval(expr)
+        result = evaluate(expr)
         await update.message.reply_text(f"Արդյունք: {result}")
     except ZeroDivisionError:
         await update.message.reply_text("Սխալ՝ բաժանում զրոյից։")
@@ -101,29 +206,27 @@ async def inline_query_handler(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ):
     query = update.inline_query.query.strip()
-    expr = convert_percent(query)
+    expr, res, valid = eval_inline_query(query)
     logger.info(f"Inline query: {expr}")
     results = []
-    if re.fullmatch(r"[0-9+\-*/(). %]+", expr):
-        try:
-            res = aeval(expr)
-            results.append(
-                InlineQueryResultArticle(
-                    id=str(uuid.uuid4()),
-                    title=f"{expr} = {res}",
-                    input_message_content=InputTextMessageContent(
-                        f"✅ {expr} = {res}"
-                    ),
-                )
+    if res is not None:
+        results.append(
+            InlineQueryResultArticle(
+                id=str(uuid.uuid4()),
+                title=f"{expr} = {res}",
+                input_message_content=InputTextMessageContent(
+                    f"✅ {expr} = {res}"
+                ),
             )
-        except:
-            results.append(
-                InlineQueryResultArticle(
-                    id=str(uuid.uuid4()),
-                    title="⚠️ Սխալ արտահայտություն",
-                    input_message_content=InputTextMessageContent("❌ Սխալ"),
-                )
+        )
+    elif valid:
+        results.append(
+            InlineQueryResultArticle(
+                id=str(uuid.uuid4()),
+                title="⚠️ Սխալ արտահայտություն",
+                input_message_content=InputTextMessageContent("❌ Սխալ"),
             )
+        )
     elif query:
         results.append(
             InlineQueryResultArticle(
@@ -153,6 +256,7 @@ if __name__ == "__main__":
     logger.info("🤖 Bot configured, entering polling loop…")
 
     # Polling loop with Conflict retry & drop_pending_updates
+    delay = 5.0
     while True:
         try:
             app.run_polling(
@@ -161,6 +265,9 @@ if __name__ == "__main__":
             )
             break
         except Conflict:
-            logger.warning("⚠️ Conflict detected—sleeping 5s then retrying…")
-            time.sleep(5)
+            delay = next_delay(delay)
+            logger.warning(
+                f"⚠️ Conflict detected—sleeping {delay:.1f}s then retrying…"
+            )
+            time.sleep(delay)
 